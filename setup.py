@@ -4,11 +4,13 @@
 Setup file for the SSI API client subpackage in SSI's python library.
 """
 
+from pathlib import Path
+
 from setuptools import setup
 
 
-with open('requirements.txt') as f:
-    requirements = f.read().splitlines()
+requirements = Path('requirements.txt').read_text(
+    encoding='utf-8').splitlines()
 
 setup(
     name='ssi.api-client',
@@ -16,13 +18,17 @@ setup(
     author='Erek Alper, Doug Johnson',
     author_email='erek.alper@subsurfaceinsights.com, dougvj@gmail.com',
     description='A subpackage containing commonly used SSI API client functions.',
-    long_description=open('README.md').read(),
+    long_description=Path('README.md').read_text(encoding='utf-8'),
     packages=['ssi'],
     package_data = {
         'ssi': ['py.typed']
     },
     zip_safe=False,
     install_requires=requirements,
+    extras_require={
+        'async': ['httpx[http2]>=0.23.0', 'websockets>=14.0'],
+        'fast': ['orjson>=3.0'],
+    },
     classifiers=[
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
@@ -4,15 +4,131 @@
 Subpackage for SSI API client calls and functionality.
 """
 
-import threading
+import contextlib
+import logging
+import math
 import os
-from pprint import pprint
-from typing import Optional
+import re
+import shutil
+import time
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+from typing import List, Optional, Tuple
 import requests
-import requests.utils
+import requests.adapters
 import json
 import websocket
 
+try:
+    import httpx
+    import websockets
+except ImportError:  # Only required for AsyncApiClient
+    httpx = None
+    websockets = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # Fall back to the (slower) standard library
+    orjson = None
+    _json_loads = json.loads
+
+
+def _has_non_finite(obj) -> bool:
+    """
+    Whether obj contains a NaN or infinite float anywhere.
+    """
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(key) or _has_non_finite(value)
+                   for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(item) for item in obj)
+    return False
+
+
+def _orjson_dumps(obj) -> Optional[bytes]:
+    """
+    Encode obj with orjson, or return None when the stdlib encoder must be
+    used instead: orjson is missing, rejects obj (such as integers over 64
+    bits), or would silently turn NaN/Infinity into null.
+    """
+    if orjson is None:
+        return None
+    try:
+        body = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        return None
+    # Non-finite floats are encoded as null, so only then is a scan needed.
+    if b'null' in body and _has_non_finite(obj):
+        return None
+    return body
+
+
+def _json_dumps(obj) -> bytes:
+    """
+    Encode obj as JSON bytes, with orjson when it gives the same result as
+    the stdlib encoder.
+    """
+    body = _orjson_dumps(obj)
+    if body is None:
+        body = json.dumps(obj).encode()
+    return body
+
+
+def _response_json(r):
+    """
+    Decode a JSON response body, parsing the raw bytes with orjson when it is
+    available to skip decoding the body into a str first.
+    """
+    if orjson is not None:
+        return orjson.loads(r.content)
+    return r.json()
+
+logger = logging.getLogger('ssi.api_client')
+
+# Setting SSI_API_TRACE enables debug logging of every call on the
+# ssi.api_client logger. A stderr handler is only added when nothing would
+# otherwise output the records, and it then stops propagation so that a root
+# handler configured later does not print every line twice.
+if os.environ.get("SSI_API_TRACE"):
+    logger.setLevel(logging.DEBUG)
+    if not logger.hasHandlers():
+        logger.addHandler(logging.StreamHandler())
+        logger.propagate = False
+
+
+def _log_async_call_failure(future: Future):
+    """
+    Log the exception of a failed async_call so it is not silently lost.
+    """
+    if future.cancelled():
+        return
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Asynchronous API call failed", exc_info=exc)
+
+
+# Read size for file downloads and minimum seconds between progress updates.
+_DOWNLOAD_CHUNK_SIZE = 1 << 16
+_PROGRESS_INTERVAL = 0.25
+
+# Error bodies longer than this are reported truncated rather than parsed.
+_ERROR_BODY_LIMIT = 4096
+
+# Default server error bodies, keyed by status (5xx collapsed to 500), that
+# are replaced with a more descriptive message.
+_GENERIC_ERRORS = {
+    404: ("Not Found", "Call \"{call}\" was not found."),
+    500: ("Internal Server Error",
+          "Call \"{call}\" failed with server error."),
+}
+
+# HTTP methods accepted by call().
+_METHODS = frozenset(('post', 'get', 'put', 'delete', 'patch', 'head'))
+
 
 class ApiException(Exception):
     """
@@ -30,28 +146,73 @@ class ApiException(Exception):
             return f"{self.request.status_code}: {self.msg}"
         return repr(self.request)
 
-class JsonWebSocket(websocket.WebSocket):
+class JsonWebSocket():
     """
-    WebSocket that sends and receives JSON.
+    Wrapper around a WebSocket that sends and receives JSON. Any other
+    attribute (send, recv, close, ...) is forwarded to the wrapped socket.
     """
+    __slots__ = ('_ws',)
+
     def __init__(self, ws: websocket.WebSocket):
-        self.__dict__.update(ws.__dict__)
+        self._ws = ws
+
+    def __getattr__(self, name):
+        if name == '_ws':
+            raise AttributeError(name)
+        return getattr(self._ws, name)
+
+    def __iter__(self):
+        return iter(self._ws)
+
+    def __next__(self):
+        return next(self._ws)
 
     def send_json(self, data):
         """
         Send JSON data.
         """
-        return self.send(json.dumps(data))
+        return self._ws.send(_json_dumps(data),
+                             opcode=websocket.ABNF.OPCODE_TEXT)
 
     def recv_json(self):
         """
         Receive JSON data.
         """
-        return json.loads(self.recv())
+        return _json_loads(self._ws.recv())
 
-class ApiClient():
+class AsyncJsonWebSocket():
     """
-    Class for simplifying SSI API REST Calls.
+    Wrapper around an asyncio websockets connection that sends and receives
+    JSON. Any other attribute is forwarded to the wrapped connection.
+    """
+    __slots__ = ('_ws',)
+
+    def __init__(self, ws):
+        self._ws = ws
+
+    def __getattr__(self, name):
+        if name == '_ws':
+            raise AttributeError(name)
+        return getattr(self._ws, name)
+
+    def __aiter__(self):
+        return self._ws.__aiter__()
+
+    async def send_json(self, data):
+        """
+        Send JSON data.
+        """
+        return await self._ws.send(_json_dumps(data), text=True)
+
+    async def recv_json(self):
+        """
+        Receive JSON data.
+        """
+        return _json_loads(await self._ws.recv())
+
+class _ApiClientBase():
+    """
+    Configuration and helpers shared by the sync and async API clients.
     """
 
     def __init__(self,
@@ -59,68 +220,42 @@ class ApiClient():
                  url: Optional[str] =None,
                  project=None):
 
+        env = os.environ
+        url = url or env.get("SSI_API_URL")
         if not url:
-            url = os.getenv("SSI_API_URL")
-            if not url:
-                raise Exception("No URL specified to ApiClient and no "
-                                "SSI_API_URL env variable found")
-        if not token:
-            token = os.getenv("SSI_API_TOKEN")
-
-        if not project:
-            project = os.getenv("SSI_API_PROJECT")
-        self.trace = os.environ.get("SSI_API_TRACE")
+            raise Exception(f"No URL specified to {type(self).__name__} "
+                            "and no SSI_API_URL env variable found")
+        token = token or env.get("SSI_API_TOKEN")
+        project = project or env.get("SSI_API_PROJECT")
+        # Deprecated and unused: kept for callers that read it. Tracing is
+        # configured once at import from SSI_API_TRACE, so changing this per
+        # client has no effect.
+        self.trace = env.get("SSI_API_TRACE")
 
         self.url = url
         self.token = token
         self.project = project
+        # Only the leading scheme is rewritten (http -> ws, https -> wss).
+        self._ws_url = re.sub(r'^http(s?)://', r'ws\1://', url)
 
-    def _get_request_headers(self):
-        """
-        Request headers.
-        """
-
-        headers = {}
+        # Headers only depend on the token and project, which do not change
+        # after construction, so build them once.
+        base_headers = {}
         if self.project:
-            headers.update({
-                'X-Paf-Project': self.project,
-            })
+            base_headers['X-Paf-Project'] = self.project
         if self.token:
-            headers.update({
-                'X-Paf-Token': self.token,
-            })
-        return headers
+            base_headers['X-Paf-Token'] = self.token
+        self._base_headers = types.MappingProxyType(base_headers)
 
-    def check_status_error(self, r, call):
+    def _get_request_headers(self):
         """
-        Check for status errors.
+        Request headers (read-only).
         """
-        if r.status_code != 200:
-            if r.headers.get('Content-Type', None) == 'application/json':
-                msg = r.json()
-            else:
-                msg = r.text
-            msg = msg.strip()
-            if r.status_code == 404:
-                raise ApiException(
-                    request=r,
-                    msg=f"Call \"{call}\" was not found." if msg == "Not Found" else msg
-                )
-            if r.status_code >= 500:
-                raise ApiException(
-                    request=r,
-                    msg=f"Call \"{call}\" failed with server error." if msg == "Internal Server Error" else msg
-                )
-            else:
-                raise ApiException(
-                    request=r,
-                    msg=msg
-                )
+        return self._base_headers
 
-    def ws(self, path: str, params: Optional[dict] = None, timeout:
-           Optional[int] = None, headers: Optional[dict] = None, **kwargs):
+    def _ws_full_url(self, path: str, params: Optional[dict]) -> str:
         """
-        Perform a SSI API websocket call.
+        Validate websocket arguments and build the full websocket URL.
         """
         if params is None:
             params = {}
@@ -130,107 +265,198 @@ class ApiClient():
             raise TypeError("Parameters must be a dictionary.")
         querystring = ""
         if params:
-            querystring = "?"
-            for key, value in params.items():
-                key = requests.utils.requote_uri(key)
-                value = requests.utils.requote_uri(str(value))
-                querystring += f"{key}={value}&"
-        headers = self._get_request_headers()
-        if headers:
-            headers.update(headers)
-        url = self.url.replace("https://", "wss://").replace("http://", "ws://")
-        full_url = f"{url}/ws/{path}{querystring}"
-        if self.trace:
-            print(f"WS: {full_url}")
-        ws = websocket.create_connection(
-            full_url,
-            timeout=timeout,
-            header=headers,
-            **kwargs
-        )
-        return JsonWebSocket(ws)
+            querystring = "?" + urlencode(params, doseq=True,
+                                        quote_via=quote)
+        full_url = f"{self._ws_url}/ws/{path}{querystring}"
+        logger.debug("WS: %s", full_url)
+        return full_url
 
-    def call(self, call: str, params: Optional[dict] = None, get_params:
-             Optional[dict] = None, method: Optional[str] = None, raw_response:
-             bool = False, headers: Optional[dict] = None, **kwargs):
+    def _prepare_call(self, call: str, params: Optional[dict],
+                      get_params: Optional[dict], method: Optional[str],
+                      headers: Optional[dict], kwargs: dict):
         """
-        Perform a SSI API call.
+        Validate call() arguments and build the request method, headers and
+        keyword arguments (body, files, query parameters) shared by the sync
+        and async clients.
         """
         if not method:
             method = 'post'
-        if not headers:
-            headers = {}
-        if self.trace:
-            print("")
-            print(f"call: {call}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("call: %s", call)
             if params:
-                print(f"params: {params}")
+                logger.debug("params: %s", params)
             if get_params:
-                print(f"get_params: {get_params}")
-            print(f"method: {method}")
-        request_method = None
+                logger.debug("get_params: %s", get_params)
+            logger.debug("method: %s", method)
         method = method.lower()
-        if method == 'post':
-            request_method = requests.post
-        elif method == 'get':
-            request_method = requests.get
-        elif method == 'put':
-            request_method = requests.put
-        elif method == 'delete':
-            request_method = requests.delete
-        elif method == 'patch':
-            request_method = requests.patch
-        elif method == 'head':
-            request_method = requests.head
-        else:
+        if method not in _METHODS:
             raise Exception(f"Unknown method: {method}")
-        if params is None:
-            params = {}
-        if not isinstance(params, dict):
+        if params is not None and not isinstance(params, dict):
             raise TypeError("Parameters must be a dictionary.")
         if not isinstance(call, str):
             raise TypeError("Call must be a string.")
-        headers.update(self._get_request_headers())
-        kwargs.update({
-            'url': f"{self.url}/api/{call}",
-            'headers': self._get_request_headers(),
-        });
-        if not params:
-            params = {}
-        files = kwargs.get('files', None)
-        if not files:
-            kwargs.update({
-                'json': params,
-            })
-        else:
-            kwargs.update({
-                'data': params,
-            })
-        if get_params:
-            kwargs.update({
-                'params': get_params,
-            })
-        r = request_method(**kwargs)
-        if self.trace:
-            print(f"API TRACE: {r.url}")
-            print("API PARAMS:")
-            pprint(params)
+        final_headers = {**self._base_headers, **(headers or {})}
+        # The URL is always derived from call.
+        kwargs.pop('url', None)
+        # A raw body supplied by the caller takes precedence over params.
+        data = kwargs.pop('data', None)
+        json_body = kwargs.pop('json', None)
+        if data is not None or json_body is not None:
+            if data is not None:
+                kwargs['data'] = data
+            if json_body is not None:
+                kwargs['json'] = json_body
+        elif kwargs.get('files', None):
+            kwargs['data'] = params or {}
+        elif params:
+            # Pre-serialize with orjson when possible, otherwise leave it to
+            # the HTTP library's encoder (which rejects NaN/Infinity).
+            body = _orjson_dumps(params)
+            if body is None:
+                kwargs['json'] = params
+            else:
+                kwargs['data'] = body
+                if not any(key.lower() == 'content-type'
+                           for key in final_headers):
+                    final_headers['Content-Type'] = 'application/json'
+        kwargs['params'] = get_params
+        return method, final_headers, kwargs
+
+    def _handle_response(self, r, call: str, raw_response: bool):
+        """
+        Check a call() response for errors and decode its body.
+        """
+        logger.debug("API TRACE: %s", r.url)
         if raw_response:
             return r
         self.check_status_error(r, call)
         ret = None
         if r.headers.get('Content-Type', None) == 'application/json':
-            ret = r.json()
+            ret = _response_json(r)
         else:
             ret = r.text
-        if self.trace:
-            print("API RESPONSE:")
-            pprint(ret)
+        logger.debug("API RESPONSE: %s", ret)
         return ret
 
+    def check_status_error(self, r, call):
+        """
+        Check for status errors.
+        """
+        if r.status_code == 200:
+            return
+        # Only the start of the body is needed to build the message, so
+        # large error pages are never parsed in full.
+        content = r.content
+        body = content[:_ERROR_BODY_LIMIT]
+        if ('json' in r.headers.get('Content-Type', '')
+                and len(content) <= _ERROR_BODY_LIMIT):
+            msg = _json_loads(body)
+        else:
+            msg = body.decode('utf-8', 'replace')
+        if isinstance(msg, str):
+            msg = msg.strip()
+        generic = _GENERIC_ERRORS.get(min(r.status_code, 500))
+        if generic is not None and msg == generic[0]:
+            msg = generic[1].format(call=call)
+        raise ApiException(request=r, msg=msg)
+
+class ApiClient(_ApiClientBase):
+    """
+    Class for simplifying SSI API REST Calls.
+    """
+
+    def __init__(self,
+                 token: Optional[str] =None,
+                 url: Optional[str] =None,
+                 project=None):
+        super().__init__(token=token, url=url, project=project)
+
+        # Persistent session so that connections are pooled and kept alive
+        # between calls instead of paying a TCP/TLS handshake every time.
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=10,
+                                                pool_maxsize=64,
+                                                max_retries=0)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        # Worker pool for async_call, created on first use.
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def close(self):
+        """
+        Close the underlying HTTP session and release pooled connections.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def ws(self, path: str, params: Optional[dict] = None, timeout:
+           Optional[int] = None, headers: Optional[dict] = None, **kwargs):
+        """
+        Perform a SSI API websocket call.
+        """
+        full_url = self._ws_full_url(path, params)
+        headers = {**self._base_headers, **(headers or {})}
+        ws = websocket.create_connection(
+            full_url,
+            timeout=timeout,
+            header=[f"{key}: {value}" for key, value in headers.items()],
+            **kwargs
+        )
+        return JsonWebSocket(ws)
+
+    @contextlib.contextmanager
+    def ws_session(self, path: str, params: Optional[dict] = None, timeout:
+                   Optional[int] = None, headers: Optional[dict] = None,
+                   **kwargs):
+        """
+        Open a SSI API websocket that stays open for the duration of a with
+        block, so many JSON messages can share one handshake::
+
+            with client.ws_session("path") as ws:
+                for request in requests:
+                    ws.send_json(request)
+                    response = ws.recv_json()
+        """
+        ws = self.ws(path, params=params, timeout=timeout, headers=headers,
+                     **kwargs)
+        try:
+            yield ws
+        finally:
+            ws.close()
+
+    def call(self, call: str, params: Optional[dict] = None, get_params:
+             Optional[dict] = None, method: Optional[str] = None, raw_response:
+             bool = False, headers: Optional[dict] = None, **kwargs):
+        """
+        Perform a SSI API call.
+        """
+        method, headers, kwargs = self._prepare_call(
+            call, params, get_params, method, headers, kwargs)
+        r = self._session.request(method=method, url=f"{self.url}/api/{call}",
+                                  headers=headers, **kwargs)
+        return self._handle_response(r, call, raw_response)
+
     def __call__(self, *args, **kwargs):
         return self.call(*args, **kwargs)
 
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """
+        Worker pool for concurrent calls, created on first use.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=min(32, (os.cpu_count() or 4) * 4))
+        return self._executor
+
     def _async_call_helper(self, call: str, params: dict, files: dict,
                            timeout: int, return_handler: callable,
                            exception_handler: callable):
@@ -239,34 +465,66 @@ class ApiClient():
         """
 
         try:
-            ret = self.call(call, params, files, timeout)
+            ret = self.call(call, params, files=files, timeout=timeout)
         except Exception as e:  # pylint: disable=broad-except
             if exception_handler:
                 exception_handler(e)
-            else:
-                raise
+                return None
+            raise
         if return_handler:
             return_handler(ret)
+        return ret
 
     def async_call(self, call: str, params: dict = None, files: dict = None,
                    timeout: int = None, return_handler: callable = None,
-                   exception_handler: callable = None):
+                   exception_handler: callable = None) -> Future:
         """
-        Perform an asynchronous SSI API call. Note that this uses threading, we
-        should support async/await in the future.
+        Perform an asynchronous SSI API call. Note that this uses a shared
+        thread pool, see AsyncApiClient for async/await.
+
+        Returns a Future resolving to the call result. When a return_handler
+        is given without an exception_handler (fire-and-forget use), a failed
+        call is also logged as an error on the ssi.api_client logger, since
+        nothing else would report it. Pool workers are not daemon threads, so
+        interpreter exit waits for pending calls to finish; use close() to
+        stop accepting new ones.
         """
 
-        thread = threading.Thread(target=self._async_call_helper, kwargs={
-            'call': call,
-            'params': params,
-            'files': files,
-            'timeout': timeout,
-            'return_handler': return_handler,
-            'exception_handler': exception_handler,
-        })
-        thread.daemon = True
-        thread.start()
-        return thread
+        future = self._get_executor().submit(
+            self._async_call_helper,
+            call=call,
+            params=params,
+            files=files,
+            timeout=timeout,
+            return_handler=return_handler,
+            exception_handler=exception_handler,
+        )
+        if return_handler and not exception_handler:
+            future.add_done_callback(_log_async_call_failure)
+        return future
+
+    def batch_call(self, calls: List[Tuple[str, Optional[dict]]],
+                   **kwargs) -> list:
+        """
+        Perform several SSI API calls concurrently over the pooled session
+        and return their results in order. Each entry of calls is a
+        (call, params) tuple; kwargs are passed to every call().
+
+        The first exception raised by any call is re-raised after cancelling
+        the calls that have not started yet. This blocks on the same bounded
+        pool as async_call, so it must not be called from a pool worker (for
+        example an async_call return_handler), which can deadlock.
+        """
+        futures = [
+            self._get_executor().submit(self.call, call, params, **kwargs)
+            for call, params in calls
+        ]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
     def file(self, path, params=None, out_filename=None, print_progress=False,
              timeout=None):
@@ -284,20 +542,100 @@ class ApiClient():
         if self.token is not None:
             params['token'] = self.token
 
-        r = requests.get('/'.join([self.url, 'api', path]), params=params,
-                          headers=self._get_request_headers(), timeout=timeout,
-                          stream=True)
+        r = self._session.get('/'.join([self.url, 'api', path]),
+                              params=params,
+                              headers=self._get_request_headers(),
+                              timeout=timeout, stream=True)
         self.check_status_error(r, path)
         if out_filename is None:
             raise ValueError("out_filename must be specified.")
         with open(out_filename, 'wb') as f:
-            if print_progress:
-                print(f"Downloading file {out_filename}:")
+            if not print_progress:
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, f, length=_DOWNLOAD_CHUNK_SIZE)
+                return
+            print(f"Downloading file {out_filename}:")
             downloaded = 0
-            for data in r.iter_content(chunk_size=4096):
+            next_report = time.monotonic() + _PROGRESS_INTERVAL
+            for data in r.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
                 downloaded += len(data)
                 f.write(data)
-                if print_progress:
+                now = time.monotonic()
+                if now >= next_report:
                     print(f"{downloaded/1024} KB downloaded.")
-            if print_progress:
-                print("Done downloading.")
+                    next_report = now + _PROGRESS_INTERVAL
+            print(f"{downloaded/1024} KB downloaded.")
+            print("Done downloading.")
+
+
+class AsyncApiClient(_ApiClientBase):
+    """
+    Class for simplifying SSI API REST Calls with asyncio. Requires the
+    optional httpx and websockets packages
+    (``pip install ssi.api-client[async]``).
+    """
+
+    def __init__(self,
+                 token: Optional[str] =None,
+                 url: Optional[str] =None,
+                 project=None):
+        if httpx is None or websockets is None:
+            raise ImportError("AsyncApiClient requires the httpx and "
+                              "websockets packages")
+        super().__init__(token=token, url=url, project=project)
+
+        # Concurrent calls are multiplexed over a shared pool of (HTTP/2
+        # capable) connections on the running event loop.
+        self._client = httpx.AsyncClient(
+            base_url=self.url,
+            http2=True,
+            headers=dict(self._base_headers),
+            limits=httpx.Limits(max_keepalive_connections=32,
+                                max_connections=128),
+        )
+
+    async def aclose(self):
+        """
+        Close the underlying HTTP client and release pooled connections.
+        """
+        await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    @contextlib.asynccontextmanager
+    async def ws(self, path: str, params: Optional[dict] = None,
+                 headers: Optional[dict] = None, **kwargs):
+        """
+        Open a SSI API websocket, used as
+        ``async with client.ws(path) as ws:``.
+        """
+        full_url = self._ws_full_url(path, params)
+        async with websockets.connect(
+            full_url,
+            additional_headers={**self._base_headers, **(headers or {})},
+            **kwargs
+        ) as ws:
+            yield AsyncJsonWebSocket(ws)
+
+    async def call(self, call: str, params: Optional[dict] = None, get_params:
+                   Optional[dict] = None, method: Optional[str] = None,
+                   raw_response: bool = False, headers: Optional[dict] = None,
+                   **kwargs):
+        """
+        Perform a SSI API call.
+        """
+        method, headers, kwargs = self._prepare_call(
+            call, params, get_params, method, headers, kwargs)
+        # httpx takes a raw body as content= rather than data=.
+        if isinstance(kwargs.get('data', None), (bytes, str)):
+            kwargs['content'] = kwargs.pop('data')
+        r = await self._client.request(method.upper(), f"/api/{call}",
+                                       headers=headers, **kwargs)
+        return self._handle_response(r, call, raw_response)
+
+    async def __call__(self, *args, **kwargs):
+        return await self.call(*args, **kwargs)